@@ -1,9 +1,12 @@
 import os
+import re
 import sys
+import time
+import random
 import logging
 import requests
 import json
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 from mcp.server.fastmcp import FastMCP
 from dotenv import load_dotenv
 
@@ -50,6 +53,38 @@ SERGEY_SEARCH_CONTEXT_SIZE = "high"  # Maximum search context for comprehensive
 GEMMA_MODEL = "gemini-2.5-pro-exp-03-25"  # Gemma uses Gemini model with extended context
 GEMMA_MAX_TOKENS = 1000000  # Massive 1M token context window for repository analysis
 GOOGLE_AI_URL = "https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent"  # Gemini API endpoint
+GEMMA_MAX_OUTPUT_TOKENS = 8192
+GEMMA_PROMPT_RESERVE_TOKENS = 16000  # Headroom for instructions, the task prompt and the reply
+GEMMA_SHARD_MAX_TOKENS = 250000  # Repository content per shard when a repository exceeds the context window
+GEMMA_MAP_CONCURRENCY = 4  # Maximum number of shards analysed at the same time
+GEMMA_PREAMBLE_MAX_FRACTION = 0.2  # Largest share of a shard the repository summary and file tree may take
+GEMMA_MAX_RETRIES = 4  # Retries for rate limited (429) or failed (5xx) Gemini requests
+GEMMA_RETRY_BACKOFF_SECONDS = 2  # Initial retry delay, doubled on each attempt
+
+GEMMA_PERSONA = "You are Gemma, an expert at codebase analysis who specializes in reviewing entire code repositories to provide comprehensive development plans."
+
+# Thinking structure based on Google's API documentation
+GEMMA_THINKING_INSTRUCTIONS = """When analyzing this request, use the following structure:
+1. Parse the feature/task requirements carefully
+2. Understand the repository structure
+3. Identify relevant components that will need modification
+4. Determine dependencies between components
+5. Formulate a comprehensive plan that includes:
+   - Files that need to be modified
+   - New files that need to be created
+   - Tests that need to be updated or added
+   - Documentation changes required"""
+
+GEMMA_PLAN_STRUCTURE = """When responding, provide a structured plan that includes:
+1. Component analysis - which parts of the code need to be modified
+2. Dependency list - what other components will be affected
+3. Testing plan - how the changes should be tested
+4. Documentation plan - what documentation needs to be updated
+
+Always cite specific files and code structures in your analysis."""
+
+CHARS_PER_TOKEN_ESTIMATE = 4  # Fallback ratio when tiktoken is unavailable
+GITINGEST_FILE_HEADER = re.compile(r"^[ \t]*={16,}\n(?:File|FILE): (.+?)\n={16,}\n", re.MULTILINE)  # Marks the start of each file in a digest
 
 def verify_api_keys() -> None:
     """Verify API keys are available"""
@@ -249,17 +284,14 @@ def consult_sergey(prompt: str, search_query: Optional[str] = None) -> str:
         logger.error(f"Response content: {response.text[:500]}...")
         raise Exception(f"Unexpected OpenAI API response format: {str(e)}")
 
-def consult_gemma(prompt: str, repo_url: str) -> str:
+def fetch_repo_digest(repo_url: str) -> str:
     """
-    Consult with Gemma using Google's Gemini API with the repository analysis capabilities.
-    Uses gitingest to fetch and process the repository content first.
+    Fetch a text digest of a repository using gitingest.
+    Tries the gitingest CLI first and falls back to the Python API.
     
     Args:
-        prompt: The prompt to send to the model
-        repo_url: The GitHub repository URL to analyze
+        repo_url: The GitHub repository URL to ingest
     """
-    verify_api_keys()
-    
     # Use gitingest to fetch repository content
     # First try the CLI approach which may be more reliable
     import subprocess
@@ -352,42 +384,189 @@ def consult_gemma(prompt: str, repo_url: str) -> str:
         logger.error(error_msg)
         repo_content = f"[Repository analysis failed: {error_msg}. Please ensure the repository exists, is public, and the URL is correct.]"
     
-    # Construct the URL for the API request
-    api_url = GOOGLE_AI_URL.format(model=GEMMA_MODEL)
-    
-    # Add API key as a query parameter
-    api_url = f"{api_url}?key={os.getenv('GOOGLE_API_KEY')}"
+    return repo_content
+
+_token_encoder = None
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimate the number of tokens in text.
+    Uses tiktoken when available, otherwise falls back to a characters-per-token heuristic.
+    Gemini uses its own tokenizer, so this is an approximation either way.
+    """
+    global _token_encoder
+    if _token_encoder is None:
+        try:
+            import tiktoken
+            _token_encoder = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            logger.warning(f"tiktoken unavailable, estimating tokens from character count: {str(e)}")
+            _token_encoder = False
     
-    # Thinking structure based on Google's API documentation
-    thinking_instructions = """
-    When analyzing this request, use the following structure:
-    1. Parse the feature/task requirements carefully
-    2. Understand the repository structure
-    3. Identify relevant components that will need modification
-    4. Determine dependencies between components
-    5. Formulate a comprehensive plan that includes:
-       - Files that need to be modified
-       - New files that need to be created
-       - Tests that need to be updated or added
-       - Documentation changes required
+    if _token_encoder:
+        return len(_token_encoder.encode(text, disallowed_special=()))
+    return len(text) // CHARS_PER_TOKEN_ESTIMATE + 1
+
+def _split_long_line(line: str, max_tokens: int) -> List[str]:
+    """
+    Cut a single line that exceeds max_tokens (e.g. minified code) into pieces by characters.
+    Each piece is re-measured and shortened until it fits, since dense text such as base64
+    or CJK packs far fewer characters into a token than the fallback ratio assumes.
+    """
+    pieces = []
+    start = 0
+    while start < len(line):
+        end = min(start + max_tokens * CHARS_PER_TOKEN_ESTIMATE, len(line))
+        tokens = estimate_tokens(line[start:end])
+        while tokens > max_tokens and end - start > 1:
+            end = start + max(1, min(end - start - 1, (end - start) * max_tokens // tokens))
+            tokens = estimate_tokens(line[start:end])
+        pieces.append(line[start:end])
+        start = end
+    return pieces
+
+def _split_text_by_lines(text: str, max_tokens: int) -> List[str]:
     """
+    Split text into chunks of at most max_tokens, breaking on line boundaries where possible.
+    """
+    chunks = []
+    current = []
+    current_tokens = 0
+    for line in text.splitlines(keepends=True):
+        line_tokens = estimate_tokens(line)
+        
+        if line_tokens > max_tokens:
+            if current:
+                chunks.append("".join(current))
+                current, current_tokens = [], 0
+            chunks.extend(_split_long_line(line, max_tokens))
+            continue
+        
+        if current and current_tokens + line_tokens > max_tokens:
+            chunks.append("".join(current))
+            current, current_tokens = [], 0
+        current.append(line)
+        current_tokens += line_tokens
+    
+    if current:
+        chunks.append("".join(current))
+    return chunks
+
+def _truncate_text(text: str, max_tokens: int) -> str:
+    """
+    Keep the leading lines of text that fit in max_tokens, noting how much was dropped.
+    """
+    chunks = _split_text_by_lines(text, max_tokens)
+    if len(chunks) <= 1:
+        return text
+    dropped_lines = text.count("\n") - chunks[0].count("\n")
+    logger.warning(f"Truncating repository summary and file tree to ~{max_tokens} tokens ({dropped_lines} lines dropped)")
+    return chunks[0] + f"\n[... file tree truncated, {dropped_lines} more lines omitted ...]\n"
+
+def split_repo_digest(repo_content: str, max_tokens: int) -> Tuple[str, List[Tuple[str, str]]]:
+    """
+    Split a gitingest digest into token-bounded shards along module boundaries.
     
-    # Format the system message
-    system_message = f"""You are Gemma, an expert at codebase analysis who specializes in reviewing entire code repositories to provide comprehensive development plans.
+    Files are grouped by their top-level directory and whole groups are packed into
+    shards. Groups that do not fit in a single shard are packed file by file, and
+    files that do not fit are split on line boundaries.
     
-    Below is the full repository content extracted using gitingest:
-
-    {repo_content}
+    The preamble is sent with every shard, so it is truncated to at most
+    GEMMA_PREAMBLE_MAX_FRACTION of max_tokens and the rest is left for file content.
     
-    {thinking_instructions}
+    Args:
+        repo_content: The full repository digest produced by gitingest
+        max_tokens: Maximum number of tokens for the preamble plus one shard
+        
+    Returns:
+        A tuple of (preamble, shards) where preamble is the summary and file tree
+        preceding the file contents, and each shard is a (label, content) pair
+    """
+    headers = list(GITINGEST_FILE_HEADER.finditer(repo_content))
+    if not headers:
+        logger.warning("No file markers found in repository digest, splitting on line boundaries")
+        chunks = _split_text_by_lines(repo_content, max_tokens)
+        return "", [(f"part {i + 1}", chunk) for i, chunk in enumerate(chunks)]
+    
+    preamble = _truncate_text(repo_content[:headers[0].start()], int(max_tokens * GEMMA_PREAMBLE_MAX_FRACTION))
+    max_tokens -= estimate_tokens(preamble)
+    
+    # Group file blocks by top-level directory, preserving digest order
+    groups: Dict[str, List[Tuple[str, str]]] = {}
+    for i, header in enumerate(headers):
+        end = headers[i + 1].start() if i + 1 < len(headers) else len(repo_content)
+        path = header.group(1).strip().lstrip("/")
+        module = path.split("/", 1)[0] if "/" in path else "(root)"
+        groups.setdefault(module, []).append((path, repo_content[header.start():end]))
+    
+    shards = []
+    current_labels = []
+    current_blocks = []
+    current_tokens = 0
+    
+    def flush() -> None:
+        nonlocal current_labels, current_blocks, current_tokens
+        if current_blocks:
+            shards.append((", ".join(current_labels), "".join(current_blocks)))
+        current_labels, current_blocks, current_tokens = [], [], 0
+    
+    for module, files in groups.items():
+        file_tokens = [estimate_tokens(block) for _, block in files]
+        group_tokens = sum(file_tokens)
+        
+        if group_tokens <= max_tokens:
+            if current_tokens + group_tokens > max_tokens:
+                flush()
+            current_labels.append(module)
+            current_blocks.extend(block for _, block in files)
+            current_tokens += group_tokens
+            continue
+        
+        # Module is too large for one shard, pack its files individually
+        flush()
+        for (path, block), tokens in zip(files, file_tokens):
+            if tokens > max_tokens:
+                flush()
+                pieces = _split_text_by_lines(block, max_tokens)
+                for j, piece in enumerate(pieces):
+                    shards.append((f"{path} (part {j + 1}/{len(pieces)})", piece))
+                continue
+            if current_tokens + tokens > max_tokens:
+                flush()
+            current_labels.append(path)
+            current_blocks.append(block)
+            current_tokens += tokens
+        flush()
+    
+    flush()
+    return preamble, shards
+
+def _retry_delay(response: Any, attempt: int) -> float:
+    """
+    Seconds to wait before retrying a Gemini request, honouring a Retry-After header if present.
+    """
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    # Exponential backoff with jitter so concurrent shard requests don't retry in lockstep
+    return GEMMA_RETRY_BACKOFF_SECONDS * (2 ** attempt) + random.uniform(0, 1)
+
+def request_gemma(text: str) -> str:
+    """
+    Send a single request to the Gemini API and return the text of the reply.
+    Rate limit (429) and server (5xx) errors are retried with exponential backoff.
     
-    When responding, provide a structured plan that includes:
-    1. Component analysis - which parts of the code need to be modified
-    2. Dependency list - what other components will be affected
-    3. Testing plan - how the changes should be tested
-    4. Documentation plan - what documentation needs to be updated
+    Args:
+        text: The full prompt, including any repository content
+    """
+    # Construct the URL for the API request
+    api_url = GOOGLE_AI_URL.format(model=GEMMA_MODEL)
     
-    Always cite specific files and code structures in your analysis."""
+    # Add API key as a query parameter
+    api_url = f"{api_url}?key={os.getenv('GOOGLE_API_KEY')}"
     
     # Format the payload according to Gemini API specs
     payload = {
@@ -395,7 +574,7 @@ def consult_gemma(prompt: str, repo_url: str) -> str:
             {
                 "role": "user",
                 "parts": [
-                    {"text": system_message + "\n\n" + prompt}
+                    {"text": text}
                 ]
             }
         ],
@@ -403,7 +582,7 @@ def consult_gemma(prompt: str, repo_url: str) -> str:
             "temperature": 0.2,
             "topP": 0.8,
             "topK": 40,
-            "maxOutputTokens": 8192
+            "maxOutputTokens": GEMMA_MAX_OUTPUT_TOKENS
         },
         "safetySettings": [
             {
@@ -429,15 +608,22 @@ def consult_gemma(prompt: str, repo_url: str) -> str:
         "Content-Type": "application/json"
     }
     
-    logger.info(f"Consulting Gemma with {len(prompt)} character prompt for repository: {repo_url}")
-    try:
-        response = requests.post(api_url, headers=headers, json=payload, timeout=120)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Google AI API request failed: {str(e)}")
-        if hasattr(e, 'response') and e.response:
-            logger.error(f"Response: {e.response.text}")
-        raise Exception(f"Google AI API request failed: {str(e)}")
+    for attempt in range(GEMMA_MAX_RETRIES + 1):
+        try:
+            response = requests.post(api_url, headers=headers, json=payload, timeout=120)
+            if (response.status_code == 429 or response.status_code >= 500) and attempt < GEMMA_MAX_RETRIES:
+                delay = _retry_delay(response, attempt)
+                logger.warning(f"Google AI API returned {response.status_code}, retrying in {delay:.1f} seconds "
+                               f"(attempt {attempt + 1}/{GEMMA_MAX_RETRIES})")
+                time.sleep(delay)
+                continue
+            response.raise_for_status()
+            break
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Google AI API request failed: {str(e)}")
+            if hasattr(e, 'response') and e.response:
+                logger.error(f"Response: {e.response.text}")
+            raise Exception(f"Google AI API request failed: {str(e)}")
     
     try:
         data = response.json()
@@ -448,9 +634,7 @@ def consult_gemma(prompt: str, repo_url: str) -> str:
             if "content" in candidate and "parts" in candidate["content"]:
                 for part in candidate["content"]["parts"]:
                     if "text" in part:
-                        answer = part["text"]
-                        logger.info(f"Gemma responded with {len(answer)} character response")
-                        return answer
+                        return part["text"]
         
         logger.error(f"Unexpected Google AI response format: {json.dumps(data)[:500]}...")
         raise Exception("Could not parse response from Google AI API")
@@ -459,6 +643,161 @@ def consult_gemma(prompt: str, repo_url: str) -> str:
         logger.error(f"Response content: {response.text[:500]}...")
         raise Exception(f"Unexpected Google AI API response format: {str(e)}")
 
+def build_gemma_message(body: str) -> str:
+    """
+    Wrap request-specific instructions and content in Gemma's shared persona and plan structure.
+    """
+    return f"{GEMMA_PERSONA}\n\n{body}\n\n{GEMMA_PLAN_STRUCTURE}"
+
+def _merge_gemma_plans(plans: List[Tuple[str, str]], preamble: str, prompt: str, total_shards: int, final: bool) -> str:
+    """
+    Ask Gemma to merge a batch of partial plans into one plan.
+    
+    Args:
+        plans: (label, plan) pairs to merge
+        preamble: Repository summary and file tree
+        prompt: The original task prompt
+        total_shards: Number of shards the repository was split into
+        final: Whether this merge produces the final plan or an intermediate one
+    """
+    plans_text = "\n\n".join(
+        f"<shard_plan covers=\"{label}\">\n{plan}\n</shard_plan>" for label, plan in plans
+    )
+    if final:
+        merge_instructions = """Merge the partial plans into a single coherent implementation plan. Remove duplicated steps,
+resolve conflicting recommendations, and connect dependencies that cross shard boundaries."""
+    else:
+        merge_instructions = """Merge these partial plans into a single plan for the parts of the repository they cover. Remove
+duplicated steps and resolve conflicting recommendations. Your plan will be merged with plans for
+other parts of the repository later, so keep any dependencies on code outside these parts."""
+    
+    body = f"""The repository was too large to analyze at once, so it was split into {total_shards} shards and each shard was analyzed separately.
+Below is the repository summary and file structure, followed by partial plans for parts of the repository:
+
+{preamble}
+
+{plans_text}
+
+{merge_instructions}"""
+    
+    return request_gemma(build_gemma_message(body) + "\n\n" + prompt)
+
+def consult_gemma(prompt: str, repo_url: str) -> str:
+    """
+    Consult with Gemma using Google's Gemini API with the repository analysis capabilities.
+    Uses gitingest to fetch and process the repository content first.
+    
+    Repositories whose digest does not fit in a single request are analysed with
+    map-reduce: the digest is split into shards along module boundaries, each shard
+    is analysed concurrently, and the per-shard plans are merged, in several rounds
+    if they do not fit in one request.
+    
+    Args:
+        prompt: The prompt to send to the model
+        repo_url: The GitHub repository URL to analyze
+    """
+    verify_api_keys()
+    
+    repo_content = fetch_repo_digest(repo_url)
+    
+    # Tokens available for repository content and plans once the prompt and reply are accounted for
+    request_budget = GEMMA_MAX_TOKENS - GEMMA_PROMPT_RESERVE_TOKENS - estimate_tokens(prompt)
+    if request_budget <= 0:
+        raise Exception(f"Prompt is too large for Gemma's {GEMMA_MAX_TOKENS} token context")
+    
+    repo_tokens = estimate_tokens(repo_content)
+    if repo_tokens <= request_budget:
+        body = f"""Below is the full repository content extracted using gitingest:
+
+{repo_content}
+
+{GEMMA_THINKING_INSTRUCTIONS}"""
+        
+        logger.info(f"Consulting Gemma with {len(prompt)} character prompt for repository: {repo_url}")
+        answer = request_gemma(build_gemma_message(body) + "\n\n" + prompt)
+        logger.info(f"Gemma responded with {len(answer)} character response")
+        return answer
+    
+    # Repository does not fit in one context, fall back to map-reduce over shards
+    from concurrent.futures import ThreadPoolExecutor
+    
+    shard_budget = min(GEMMA_SHARD_MAX_TOKENS, request_budget)
+    preamble, shards = split_repo_digest(repo_content, shard_budget)
+    logger.info(f"Repository digest is ~{repo_tokens} tokens, exceeding the {GEMMA_MAX_TOKENS} token context; "
+                f"analysing {len(shards)} shards with concurrency {GEMMA_MAP_CONCURRENCY}")
+    
+    def analyse_shard(index: int, label: str, content: str) -> str:
+        body = f"""The repository is too large to analyze at once, so it has been split into {len(shards)} shards.
+You are analyzing shard {index + 1} of {len(shards)}, covering: {label}
+
+Below is the repository summary and file structure, followed by the content of this shard extracted using gitingest:
+
+{preamble}
+
+{content}
+
+{GEMMA_THINKING_INSTRUCTIONS}
+
+Your plan will be merged with plans for the other shards, so limit it to the code in this shard.
+Note any dependencies on code outside this shard so they can be reconciled.
+If nothing in this shard is relevant to the task, say so briefly."""
+        
+        logger.info(f"Consulting Gemma on shard {index + 1}/{len(shards)} ({label})")
+        answer = request_gemma(build_gemma_message(body) + "\n\n" + prompt)
+        logger.info(f"Gemma responded to shard {index + 1}/{len(shards)} with {len(answer)} character response")
+        return answer
+    
+    with ThreadPoolExecutor(max_workers=GEMMA_MAP_CONCURRENCY) as executor:
+        futures = [executor.submit(analyse_shard, i, label, content) for i, (label, content) in enumerate(shards)]
+    
+    plans = []
+    failed_shards = []
+    for i, ((label, _), future) in enumerate(zip(shards, futures)):
+        try:
+            plans.append((label, future.result()))
+        except Exception as e:
+            logger.error(f"Gemma failed to analyse shard {i + 1}/{len(shards)} ({label}): {str(e)}")
+            failed_shards.append(label)
+    
+    if not plans:
+        raise Exception(f"Gemma failed to analyse all {len(shards)} repository shards")
+    
+    # Merge in rounds until the remaining plans fit in a single request
+    merge_budget = request_budget - estimate_tokens(preamble)
+    while len(plans) > 1 and sum(estimate_tokens(plan) for _, plan in plans) > merge_budget:
+        batches = []
+        batch_tokens = 0
+        for label, plan in plans:
+            tokens = estimate_tokens(plan)
+            # Every batch takes at least two plans so each round makes progress
+            if batches and len(batches[-1]) >= 2 and batch_tokens + tokens > merge_budget:
+                batches.append([])
+                batch_tokens = 0
+            if not batches:
+                batches.append([])
+            batches[-1].append((label, plan))
+            batch_tokens += tokens
+        
+        logger.info(f"Shard plans exceed the context, merging {len(plans)} plans in {len(batches)} batches")
+        with ThreadPoolExecutor(max_workers=GEMMA_MAP_CONCURRENCY) as executor:
+            futures = [
+                executor.submit(_merge_gemma_plans, batch, preamble, prompt, len(shards), False)
+                for batch in batches
+            ]
+        plans = [
+            ("; ".join(label for label, _ in batch), future.result())
+            for batch, future in zip(batches, futures)
+        ]
+    
+    logger.info(f"Consulting Gemma to merge {len(plans)} shard plans for repository: {repo_url}")
+    answer = _merge_gemma_plans(plans, preamble, prompt, len(shards), True)
+    logger.info(f"Gemma responded with {len(answer)} character merged response")
+    
+    if failed_shards:
+        answer += ("\n\n---\n**Note:** The following shards could not be analysed and are not covered by this plan. "
+                   f"Shards not analysed: {'; '.join(failed_shards)}")
+    return answer
+
 @mcp.tool()
 async def consult_with_darren(consultation_context: str, source_code: Optional[str] = None) -> str:
     """Consult with Darren (OpenAI o3-mini) about a coding problem.